@@ -1,3 +1,10 @@
+'''An extended CKY recogniser over NLTK grammars
+
+Deliberately pure Python with no CPython-specific extensions, so for
+batch workloads the whole module runs unmodified (and typically several
+times faster) under PyPy, whose JIT compiles the _binary_scan kernel
+and the Cell/Label classes wholesale.
+'''
 import sys,re
 import nltk
 from collections import defaultdict
@@ -8,6 +15,84 @@ from pprint import pprint
 #  to make this file easier to read
 from cky_print import CKY_pprint, CKY_log, Cell__str__, Cell_str, Cell_log
 
+def _binary_scan(n,pairs,rowbits,colbits):
+    '''Numeric kernel of the non-verbose binaryScan.
+
+    Deliberately a module-level function over plain ints, lists and
+    tuples -- no self, no closures -- so the hot loop touches only fast
+    locals, and a JIT (Numba/PyPy) could compile it wholesale if one is
+    ever available.  Mutates rowbits/colbits (the per-rule-child
+    bit-vectors over chart positions) as cells fill up.
+
+    :type n: int
+    :param n: chart dimension (sentence length + 1)
+    :type pairs: list((int,int,int))
+    :param pairs: (id1,id2,contribution-bitmask) per binary rule pair
+    :type rowbits, colbits: dict(int:list(int))
+    :param rowbits, colbits: bit-vectors seeded from the diagonal
+    :rtype: list((int,int,int))
+    :return: (start,end,label-bitmask) for every cell that gained labels'''
+    # aggregate occupancy: any_row[start] has bit mid set iff (start,mid)
+    #  holds some left child of a binary rule, any_col[end] likewise for
+    #  right children.  One AND of the two tells us whether any split
+    #  point of a cell can combine at all, before touching the rules.
+    any_row=[0]*n
+    any_col=[0]*n
+    for vec in rowbits.values():
+        for i in range(n):
+            any_row[i] |= vec[i]
+    for vec in colbits.values():
+        for i in range(n):
+            any_col[i] |= vec[i]
+    out=[]
+    for span in range(2, n):
+        _scan_span(span,n,pairs,rowbits,colbits,any_row,any_col,out)
+    return out
+
+def _scan_span(span,n,pairs,rowbits,colbits,any_row,any_col,out):
+    '''Fill every cell of one span length (one chart anti-diagonal).
+
+    Split out because this is the natural parallel unit of CKY: cells
+    of a span read only strictly shorter spans, and each (start,end)
+    writes distinct entries, so the starts of one call are mutually
+    independent and could be fanned out to workers under a runtime
+    without a GIL.  Under CPython we call the spans in sequence, which
+    is the same dependency order.
+
+    :type span: int
+    :param span: constituent length handled by this call
+    :param n, pairs, rowbits, colbits: as in _binary_scan
+    :type any_row, any_col: list(int)
+    :param any_row, any_col: aggregate occupancy bit-vectors
+    :type out: list((int,int,int))
+    :param out: accumulator for (start,end,label-bitmask) results'''
+    for start in range(n-span):
+        end = start + span
+        if not any_row[start] & any_col[end]:
+            # no split point offers both a viable left and right
+            #  child -- skip the rule loop for this cell entirely
+            continue
+        m=0
+        for id1,id2,contrib in pairs:
+            if rowbits[id1][start] & colbits[id2][end]:
+                m |= contrib
+        if m:
+            out.append((start,end,m))
+            # publish the new bits to the child bit-vectors
+            rest=m
+            end_bit=1<<end
+            start_bit=1<<start
+            while rest:
+                bit=rest&-rest
+                rest-=bit
+                sid=bit.bit_length()-1
+                if sid in rowbits:
+                    rowbits[sid][start] |= end_bit
+                    any_row[start] |= end_bit
+                if sid in colbits:
+                    colbits[sid][end] |= start_bit
+                    any_col[end] |= start_bit
+
 class CKY:
     """An implementation of the Cocke-Kasami-Younger (bottom-up) CFG recogniser.
 
@@ -16,7 +101,7 @@ class CKY:
     ones, that is X -> Y with either Y -> A B or Y -> Z .
     It also allows mixed binary productions, that is NT -> NT T or -> T NT"""
 
-    def __init__(self,grammar):
+    def __init__(self,grammar,max_len=None):
         '''Create an extended CKY processor for a particular grammar
 
         Grammar is an NLTK CFG
@@ -29,14 +114,28 @@ class CKY:
 
         :type grammar: nltk.grammar.CFG, as fixed by cfg_fix
         :param grammar: A context-free grammar
+        :type max_len: int or None
+        :param max_len: if given, preallocate one pool of Cells big
+        enough for sentences of up to max_len words; recognise then
+        reuses (resets) the pool per parse instead of building a fresh
+        matrix, which matters when batch-parsing many sentences
         :return: none
         '''
 
         self.verbose=False
         assert(isinstance(grammar,CFG))
         self.grammar=grammar
+        # cached so recognise doesn't re-invoke NLTK's method per parse
+        self._start=grammar.start()
         # split and index the grammar
         self.buildIndices(grammar.productions())
+        self._pool=None
+        self._pool_n=0
+        if max_len is not None:
+            self._pool_n=max_len+1
+            self._pool=[Cell(r,c,self)
+                        for r in range(self._pool_n-1)
+                        for c in range(r+1,self._pool_n)]
 
     def buildIndices(self,productions):
         '''
@@ -49,6 +148,11 @@ class CKY:
         '''
         self.unary = defaultdict(list)
         self.binary = defaultdict(list)
+        # two-level index over the binary rules: first child -> second
+        #  child -> list of parents.  Lets maybeBuild probe per-child
+        #  instead of hashing an (s1,s2) tuple for every label pair, and
+        #  skip a whole inner loop when s1 starts no binary rule.
+        self.binary_left = defaultdict(dict)
         for production in productions:
             rhs=production.rhs()
             lhs=production.lhs()
@@ -57,6 +161,116 @@ class CKY:
                 self.unary[rhs[0]].append(lhs)
             else:
                 self.binary[rhs].append(lhs)
+                self.binary_left[rhs[0]].setdefault(rhs[1],[]).append(lhs)
+        # Duplicate productions (common after grammar transforms) would
+        #  put duplicate parents in these lists and waste inner-loop
+        #  work, so deduplicate once and freeze to tuples -- slightly
+        #  faster to iterate, and safe from accidental mutation.
+        #  (dict.fromkeys deduplicates while keeping first-seen order)
+        for index in (self.unary,self.binary):
+            for k,v in index.items():
+                index[k]=tuple(dict.fromkeys(v))
+        for row in self.binary_left.values():
+            for s2,v in row.items():
+                row[s2]=tuple(dict.fromkeys(v))
+        # freeze the defaultdicts to plain dicts now that they are
+        #  complete: lookups in the scan go through .get, and a stray
+        #  [] probe can no longer grow the index silently
+        self.unary=dict(self.unary)
+        self.binary=dict(self.binary)
+        self.binary_left=dict(self.binary_left)
+        # The unary relation is fixed by the grammar, so take its
+        #  transitive closure once here rather than re-walking the same
+        #  chains at every label insertion.  unary_closure[sym] lists every
+        #  symbol reachable from sym by a chain of unary rules, in the
+        #  order the old recursive walk would first reach them (sym itself
+        #  is not included, matching unaryUpdate's behaviour).
+        #  Kept both as a tuple (discovery order, for ordered bulk
+        #  extends) and as a frozenset (for batched set-difference
+        #  against a cell's existing labels).
+        self.unary_closure = {}
+        self.unary_closure_set = {}
+        for sym in self.unary:
+            closure=tuple(self._closureOrder(sym))
+            self.unary_closure[sym]=closure
+            self.unary_closure_set[sym]=frozenset(closure)
+        # The diagonal's contents depend only on the word, so keep a
+        #  terminal-only view of the closure table for unaryFill: a
+        #  smaller dict than unary_closure (terminals are the str keys)
+        #  probed once per word.  A word missing here gets no labels,
+        #  which is exactly what the closure walk would produce.
+        self.terminal_init={}
+        for sym,closure in self.unary_closure.items():
+            if isinstance(sym,str):
+                self.terminal_init[sym]=closure
+        # Give every grammar symbol a small integer ID so a cell's label
+        #  set can be packed into a single int bitmask: union is one |,
+        #  membership one shift-and-test, and a machine word covers 64
+        #  symbols at a time.
+        self.id2sym=[]
+        self.sym2id={}
+        for production in productions:
+            for sym in (production.lhs(),)+production.rhs():
+                if sym not in self.sym2id:
+                    self.sym2id[sym]=len(self.id2sym)
+                    self.id2sym.append(sym)
+        # unary closure as a bitmask per symbol ID (the ID's own bit is
+        #  not set: a symbol never labels a cell just by being built)
+        self.unary_closure_mask={}
+        for sym,parents in self.unary_closure.items():
+            mask=0
+            for parent in parents:
+                mask |= 1<<self.sym2id[parent]
+            self.unary_closure_mask[self.sym2id[sym]]=mask
+        # bitmask mirror of binary_left: first child ID -> second child
+        #  ID -> bitmask of every label the pair contributes to a cell.
+        #  That is the union of the parents' unary closures, so the whole
+        #  closure application collapses to one | in the scan.
+        self.binary_left_mask={}
+        for s1,row in self.binary_left.items():
+            row_mask={}
+            for s2,lhs_list in row.items():
+                mask=0
+                for lhs in lhs_list:
+                    mask |= self.unary_closure_mask.get(self.sym2id[lhs],0)
+                if mask:
+                    row_mask[self.sym2id[s2]]=mask
+            if row_mask:
+                self.binary_left_mask[self.sym2id[s1]]=row_mask
+        # flat (id1,id2,contribution) triples over the same index, for
+        #  the boolean-matrix formulation of binaryScan
+        self.binary_pairs=[]
+        for id1,row_mask in self.binary_left_mask.items():
+            for id2,mask in row_mask.items():
+                self.binary_pairs.append((id1,id2,mask))
+
+    def _closureOrder(self,sym):
+        '''Depth-first discovery order of all unary ancestors of sym,
+        i.e. the order the recursive unaryUpdate walk would first add them
+        :param sym: a terminal or non-terminal
+        :rtype: list
+        :return: unary ancestors of sym, nearest chains first'''
+        seen=set()
+        out=[]
+        def walk(below):
+            for parent in self.unary.get(below,[]):
+                if parent not in seen:
+                    seen.add(parent)
+                    out.append(parent)
+                    walk(parent)
+        walk(sym)
+        return out
+
+    def _idx(self,start,end):
+        '''Slot of cell (start,end) in the packed upper-triangular matrix
+        (standard row-major packing of the strict upper triangle).
+        Packing is relative to _matrix_n, the dimension the current
+        matrix was built for, which exceeds n when a pooled matrix is
+        being reused for a shorter sentence.
+        :param start, end: row and column indices, start < end
+        :rtype: int
+        :return: index into self.matrix'''
+        return start*(2*self._matrix_n-start-1)//2+(end-start-1)
 
     def recognise(self,tokens,verbose=False):
         '''
@@ -73,10 +287,16 @@ class CKY:
         :return: return whether a sentence is representable by given grammar by checking whether the top-right cell is
         in the grammar
         '''
+        if not tokens:
+            # No empty rules (see the class docstring), so the empty
+            #  sentence is never grammatical.  Bail out before building
+            #  a chart: with n == 1 there is no top cell, and a pooled
+            #  matrix would otherwise hand back a stale cell from the
+            #  previous parse via matrix[-1].
+            return False
         self.verbose=verbose
         self.words = tokens
         self.n = len(self.words)+1
-        self.matrix = []
         # We index by row, then column
         #  So Y below is 1,2 and Z is 0,3
         #    1   2   3  ...
@@ -84,26 +304,35 @@ class CKY:
         # 1      Y   .
         # 2          .
         # ...
-        # initialize matrix and set empty cells for upper diagnose
-        for r in range(self.n-1):
-             # rows
-             row=[]
-             for c in range(self.n):
-                 # columns
-                 if c>r:
-                     # This is one we care about, add a cell
-                     row.append(Cell(r,c,self))
-                 else:
-                     # just a filler
-                     row.append(None)
-             self.matrix.append(row)
+        # Only the strict upper triangle is ever used, so rather than a
+        #  list of lists padded with None fillers we pack the cells into
+        #  one flat list, row-major; _idx maps (row,column) to its slot.
+        #  Half the memory, and one indexing step instead of two.
+        if self._pool is not None and self.n<=self._pool_n:
+            # reuse the preallocated pool: reset just the cells this
+            #  sentence needs rather than reallocating the lot
+            self._matrix_n=self._pool_n
+            self.matrix=self._pool
+            idx=self._idx
+            for r in range(self.n-1):
+                for c in range(r+1,self.n):
+                    self.matrix[idx(r,c)].reset()
+        else:
+            # no pool, or the sentence outgrew it
+            self._matrix_n=self.n
+            self.matrix = []
+            for r in range(self.n-1):
+                 # rows
+                 for c in range(r+1,self.n):
+                     # columns of the upper triangle
+                     self.matrix.append(Cell(r,c,self))
         self.unaryFill()
         self.binaryScan()
+        top=self.matrix[self._idx(0,self.n-1)]
         # Replace the line below for Q6
-        if self.grammar.start() not in self.matrix[0][self.n-1].labels():
-            return False
-        else:
-            return len(self.matrix[0][self.n-1].labels())
+        # set membership rather than a scan of the label list; yields
+        #  False or the (truthy) label count exactly as before
+        return (self._start in top._labels) and len(top._labels)
 
     def unaryFill(self):
         '''
@@ -111,13 +340,27 @@ class CKY:
         constituent labels.
 
         How: Add word and label from top left to bottom right of table by using unaryUpdate to label cells with parent node.
+        The verbose test is made once here, not per word: the quiet path
+        applies each word's unary closure directly so no logging call
+        (or argument formatting) happens at all on the way.
         '''
 
+        idx=self._idx
+        if self.verbose:
+            for r in range(self.n-1):
+                cell=self.matrix[idx(r,r+1)]
+                word=self.words[r]
+                #cell.addLabel(word)
+                cell.unaryUpdate(word)
+            return
+        terminal_init=self.terminal_init.get
+        words=self.words
         for r in range(self.n-1):
-            cell=self.matrix[r][r+1]
-            word=self.words[r]
-            #cell.addLabel(word)
-            cell.unaryUpdate(word)
+            init=terminal_init(words[r])
+            if init:
+                # diagonal cells start empty, so their containers can be
+                #  rebuilt wholesale from the memoised labels
+                self.matrix[idx(r,r+1)]._labels=dict.fromkeys(init)
 
     def binaryScan(self):
         '''(The heart of the implementation.)
@@ -133,13 +376,57 @@ class CKY:
         of (start, mid, end) positions to try to build something at
         those positions.
 
+        When verbose, delegates to maybeBuild for each position so the
+        trace is printed.  Otherwise runs the Valiant-style boolean
+        matrix formulation of the same search: for a rule A -> B C,
+        "A fits (start,end)" is  exists mid: B in (start,mid) and
+        C in (mid,end), i.e. a boolean vector product.  We keep, per
+        rule child, an int bit-vector over the chart positions
+        (rowbits[B][start] has bit mid set iff B labels (start,mid),
+        colbits[C][end] has bit mid set iff C labels (mid,end)), so the
+        whole mid loop for one rule collapses to a single AND of two
+        ints, word-parallel over all split points.
+
         :return: none
         '''
-        for span in range(2, self.n):
-            for start in range(self.n-span):
-                end = start + span
-                for mid in range(start+1, end):
-                    self.maybeBuild(start, mid, end)
+        if self.verbose:
+            for span in range(2, self.n):
+                for start in range(self.n-span):
+                    end = start + span
+                    for mid in range(start+1, end):
+                        self.maybeBuild(start, mid, end)
+            return
+        matrix=self.matrix
+        idx=self._idx
+        sym2id=self.sym2id
+        id2sym=self.id2sym
+        pairs=self.binary_pairs
+        n=self.n
+        # per-child bit-vectors over chart positions; because cells are
+        #  visited in increasing span order, the set bits are exactly
+        #  the valid mids start < mid < end, so no range masking needed
+        rowbits={}
+        colbits={}
+        for id1,id2,mask in pairs:
+            if id1 not in rowbits:
+                rowbits[id1]=[0]*n
+            if id2 not in colbits:
+                colbits[id2]=[0]*n
+        # seed from the diagonal filled by unaryFill
+        for r in range(n-1):
+            for label in matrix[idx(r,r+1)]._labels:
+                sid=sym2id[label]
+                if sid in rowbits:
+                    rowbits[sid][r] |= 1<<(r+1)
+                if sid in colbits:
+                    colbits[sid][r+1] |= 1<<r
+        # materialise the labels of every cell the kernel filled
+        for start,end,m in _binary_scan(n,pairs,rowbits,colbits):
+            cell_labels=matrix[idx(start,end)]._labels
+            while m:
+                bit=m&-m
+                m-=bit
+                cell_labels[id2sym[bit.bit_length()-1]]=None
 
     def maybeBuild(self, start, mid, end):
         '''
@@ -153,45 +440,86 @@ class CKY:
         '''
 
         self.log("%s--%s--%s:",start, mid, end)
-        cell=self.matrix[start][end]
-        for s1 in self.matrix[start][mid].labels():
-            for s2 in self.matrix[mid][end].labels():
-                if (s1,s2) in self.binary:
-                    for s in self.binary[(s1,s2)]:
-                        self.log("%s -> %s %s", s, s1, s2, indent=1)
-                        #cell.addLabel(s)
-                        cell.unaryUpdate(s,1)
+        idx=self._idx
+        cell=self.matrix[idx(start,end)]
+        right=self.matrix[idx(mid,end)]._labels
+        for s1 in self.matrix[idx(start,mid)]._labels:
+            row=self.binary_left.get(s1)
+            if row is None:
+                continue
+            for s2 in right:
+                lhs_list=row.get(s2)
+                if lhs_list is None:
+                    continue
+                for s in lhs_list:
+                    self.log("%s -> %s %s", s, s1, s2, indent=1)
+                    #cell.addLabel(s)
+                    cell.unaryUpdate(s,1)
 
 # helper methods from cky_print
 CKY.pprint=CKY_pprint
 CKY.log=CKY_log
 
 class Cell:
-    '''A cell in a CKY matrix'''
+    '''A cell in a CKY matrix
+
+    Cells are created O(n^2) per parse, so __slots__ drops the
+    per-instance __dict__: roughly a third of the memory, and slot
+    descriptors are quicker to load than dict entries in the hot
+    loops.  (The printing helpers bound onto the class below are class
+    attributes, which __slots__ does not restrict.)'''
+    __slots__=('_row','_column','matrix','_labels')
+
     def __init__(self,row,column,matrix):
         self._row=row
         self._column=column
         self.matrix=matrix
-        self._labels=[]
+        # a dict with None values: O(1) duplicate checks like a set,
+        #  but iteration keeps insertion order (one container instead
+        #  of the earlier parallel set + list)
+        self._labels={}
 
     def addLabel(self,label):
         if label not in self._labels:
-            self._labels.append(label)
+            self._labels[label]=None
 
     def labels(self):
-        return self._labels
+        return list(self._labels)
+
+    def reset(self):
+        '''Empty the cell so a pooled matrix can be reused for the next
+        parse without reallocating Cells'''
+        self._labels.clear()
 
     def unaryUpdate(self,symbol,depth=0,recursive=False):
         '''
         Postcondition: Prints unary rule from grammar that led to filling a cell in the CKY matrix and their parent rules.
-        How: Looks up child node (rhs) in unary dictionary and adds parent node (lhs) to cell
+        How: Looks up the precomputed unary closure of the symbol and adds every ancestor to the cell.
+        When verbose, falls back to the original recursive walk over the unary dictionary so that the
+        rule-by-rule trace is still printed.
         @:param symbol: word
         '''
+        matrix=self.matrix
+        if not matrix.verbose:
+            # the closure is exactly what the recursion below would add;
+            #  apply it batched, with dedup done in C set ops rather
+            #  than one addLabel call per ancestor
+            closure=matrix.unary_closure.get(symbol)
+            if not closure:
+                return
+            labels=self._labels
+            if not labels:
+                labels.update(dict.fromkeys(closure))
+                return
+            new=matrix.unary_closure_set[symbol].difference(labels)
+            if new:
+                labels.update(dict.fromkeys(new))
+            return
         if not recursive:
             self.log(str(symbol),indent=depth)
-        if symbol in self.matrix.unary:
-            for parent in self.matrix.unary[symbol]:
-                self.matrix.log("%s -> %s",parent,symbol,indent=depth+1)
+        if symbol in matrix.unary:
+            for parent in matrix.unary[symbol]:
+                matrix.log("%s -> %s",parent,symbol,indent=depth+1)
                 self.addLabel(parent)
                 self.unaryUpdate(parent,depth+1,True)
 
@@ -205,7 +533,14 @@ class Label:
 
     Includes a terminal or non-terminal symbol, possibly other
     information.  Add more to this docstring when you start using this
-    class'''
+    class
+
+    Built to be cheap as a dict/set key: the hash of the underlying
+    symbol is computed once at construction (hashing an
+    nltk.grammar.Nonterminal repeatedly is not free), and __slots__
+    drops the per-instance __dict__.'''
+    __slots__=('_symbol','_hash')
+
     def __init__(self,symbol,
                  # Fill in here, if more needed
                  ):
@@ -215,19 +550,26 @@ class Label:
         :return: none
         '''
         self._symbol=symbol
+        self._hash=hash(symbol)
         # augment as appropriate, with comments
 
     def __str__(self):
         return str(self._symbol)
 
+    def __hash__(self):
+        '''Memoised hash of the symbol, so repeated keying of the same
+        label is a plain attribute load
+        :rtype: int
+        :return: hash of the symbol'''
+        return self._hash
+
     def __eq__(self,other):
         '''How to test for equality -- other must be a label,
         and symbols have to be equal
         :rtype: bool
         :return: True iff symbols are equal, else False
         '''
-        assert isinstance(other,Label)
-        return self._symbol==other._symbol
+        return other.__class__ is Label and self._symbol==other._symbol
 
     def symbol(self):
         return self._symbol
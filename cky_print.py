@@ -15,7 +15,7 @@ def CKY_pprint(self,cell_width=8):
              if c>r:
                  # This is one we care about, get a cell form
                  #  and tabulate width, height and update maxima
-                 cf=self.matrix[r][c].str(cell_width)
+                 cf=self.matrix[self._idx(r,c)].str(cell_width)
                  nlines=len(cf)
                  if nlines>row_max_height[r]:
                      row_max_height[r]=nlines
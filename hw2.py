@@ -92,8 +92,9 @@ chart = CKY(grammar)
 chart.recognise(tokenise("the frogs swim"), True)
 chart.pprint()
 
-# build a chart with the larger grammar
-chart2 = CKY(grammar2)
+# build a chart with the larger grammar; we recognise a batch of
+#  sentences with it below, so let it preallocate and reuse its cells
+chart2 = CKY(grammar2, max_len=20)
 
 # Note, please do _not_ use the Tree.draw() method uncommented
 # _anywhere in this file_ (you are encouraged to use it in preparing